@@ -19,7 +19,10 @@
 import argparse
 from os import path
 
-from src.scoring import Scoring
+from src.scoring import (
+    Scoring, ResultCache, ProgressReporter, ThresholdSweep, CountStore,
+    VERSION
+)
 
 
 def non_empty_file(arg):
@@ -36,6 +39,49 @@ def positive_int(arg):
     return int(arg)
 
 
+def positive_size(arg):
+    if int(arg) <= 0:
+        raise argparse.ArgumentTypeError('Size must be greater than zero')
+    return int(arg)
+
+
+def positive_interval(arg):
+    if float(arg) <= 0:
+        raise argparse.ArgumentTypeError(
+            'Progress interval must be greater than zero'
+        )
+    return float(arg)
+
+
+def threshold_list(arg):
+    try:
+        thresholds = [int(threshold) for threshold in arg.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid list of mismatch numbers: '{arg}'"
+        )
+    if any(threshold < 0 for threshold in thresholds):
+        raise argparse.ArgumentTypeError('Mismatch number cannot be negative')
+    return thresholds
+
+
+def name_list(arg):
+    names = set(arg.split(','))
+    if '' in names:
+        raise argparse.ArgumentTypeError(f"Invalid list of names: '{arg}'")
+    return names
+
+
+def partition_mode(arg):
+    if arg == 'targeton':
+        return arg
+    if not arg.isdigit() or int(arg) == 0:
+        raise argparse.ArgumentTypeError(
+            f"Partition must be 'targeton' or a number of buckets: '{arg}'"
+        )
+    return int(arg)
+
+
 def new_file_path(arg):
     if arg.endswith('/') or path.isdir(arg):
         raise argparse.ArgumentTypeError(
@@ -70,10 +116,85 @@ def add_arguments(parser):
         ),
         type=non_empty_file
     )
+    parser.add_argument(
+        '--pairs',
+        help='Comma-separated primer pairs - only these pairs are scored',
+        type=name_list
+    )
+    parser.add_argument(
+        '--targetons',
+        help=(
+            'Comma-separated targetons - only primer pairs for these'
+            ' targetons in the targeton CSV are scored'
+        ),
+        type=name_list
+    )
+    parser.add_argument(
+        '--csv_pairs_only',
+        help='Only score primer pairs listed in the targeton CSV',
+        action='store_true'
+    )
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument(
+        '--count_store',
+        help=(
+            'SQLite file to add counts to and score from'
+            ' - for inputs too large to count in memory'
+        )
+    )
+    modes.add_argument(
+        '--partition',
+        help=(
+            "'targeton' or a number of buckets - writes one TSV per"
+            ' targeton or hash bucket of primer pairs, plus a manifest,'
+            ' into output_tsv as a new directory'
+        ),
+        type=partition_mode
+    )
+    modes.add_argument(
+        '--sweep',
+        help=(
+            'Comma-separated mismatch numbers up to the iPCRess mismatch'
+            ' number - outputs scores and ranks for each from a single pass'
+        ),
+        type=threshold_list
+    )
+    parser.add_argument(
+        '--cache_dir',
+        help=(
+            'Directory for cached mismatch counts'
+            ' - reused when scoring the same inputs again'
+        )
+    )
+    parser.add_argument(
+        '--cache_size',
+        help='Maximum size of cache directory in MB (default: 1024)',
+        type=positive_size,
+        default=1024
+    )
+    parser.add_argument(
+        '--progress',
+        help='Report parsing progress to stderr',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--progress_interval',
+        help='Seconds between progress reports (default: 10)',
+        type=positive_interval,
+        default=10
+    )
+    parser.add_argument(
+        '--metrics_file',
+        help='Append progress metrics to this JSON lines file'
+    )
+    parser.add_argument(
+        '--prometheus_file',
+        help='Write progress metrics to this Prometheus textfile'
+    )
     parser.add_argument(
         '--version',
         action='version',
-        version='%(prog)s 1.0.0'
+        version=f'%(prog)s {VERSION}'
     )
 
 
@@ -87,13 +208,64 @@ def parse_arguments():
             ' 4 example_output.tsv'
         ))
     add_arguments(parser)
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.cache_dir and (args.count_store or args.sweep):
+        parser.error(
+            'argument --cache_dir: not allowed with argument '
+            f"{'--count_store' if args.count_store else '--sweep'}"
+        )
+    return args
 
 
 def main():
     args = parse_arguments()
-    scoring = Scoring(args.ipcress_file, args.mismatch, args.targeton_csv)
+    buckets = None
+    if args.partition:
+        buckets = None if args.partition == 'targeton' else args.partition
+        Scoring.check_partition(buckets, args.targeton_csv)
+    pairs = Scoring.select_pairs(
+        args.pairs, args.targetons, args.targeton_csv, args.csv_pairs_only
+    )
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, args.cache_size * 2 ** 20)
+    progress = None
+    if args.progress or args.metrics_file or args.prometheus_file:
+        progress = ProgressReporter(
+            args.progress_interval,
+            metrics_file=args.metrics_file,
+            prometheus_file=args.prometheus_file,
+            quiet=not args.progress
+        )
+    if args.count_store:
+        store = CountStore(args.count_store, args.mismatch)
+        if args.targeton_csv:
+            store.add_targetons(args.targeton_csv)
+        store.add_ipcress(args.ipcress_file, progress, pairs)
+        store.write_tsv(args.output_tsv)
+        store.close()
+        print(f"Scoring complete! File saved to '{args.output_tsv}'")
+        return
+    if args.sweep:
+        sweep = ThresholdSweep(
+            args.ipcress_file, args.mismatch, args.sweep,
+            args.targeton_csv, progress, pairs
+        )
+        stability_tsv = sweep.save_sweep(args.output_tsv)
+        print(
+            f"Scoring complete! File saved to '{args.output_tsv}', "
+            f"rank stability saved to '{stability_tsv}'"
+        )
+        return
+    scoring = Scoring(
+        args.ipcress_file, args.mismatch, args.targeton_csv,
+        cache, progress, pairs
+    )
     scoring.add_scores_to_df()
+    if args.partition:
+        manifest = scoring.save_partitioned(args.output_tsv, buckets)
+        print(f"Scoring complete! Manifest saved to '{manifest}'")
+        return
     scoring.save_mismatches(args.output_tsv)
     print(f"Scoring complete! File saved to '{args.output_tsv}'")
 
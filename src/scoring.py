@@ -14,121 +14,281 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+import hashlib
+import json
+import mmap
+import os
+import pickle
 import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
 from pathlib import Path
 
 import pandas as pd
 import numpy as np
 
 
+VERSION = '1.0.0'
+IPCRESS_LINE = re.compile(
+    rb'ipcress: \S+ '  # ipcress: 11:filter(unmasked)
+    rb'(\S+) \d+ '  # SMARCA4_exon24_1 204
+    rb'([A|B]) \d+ (\d+) '  # A 3231378 4
+    rb'([A|B]) \d+ (\d+) '  # A 3231564 4
+    rb'[a-zAB_]+\r?\n'  # single_A
+)
+IPCRESS_END = re.compile(rb'-- completed ipcress analysis\r?\n')
+IPCRESS_PAIR = re.compile(rb'ipcress: \S+ (\S+) ')
+PROGRESS_LINES = 2 ** 16  # lines read between progress checks
+MANIFEST_FILE = 'manifest.tsv'  # written alongside partitioned output
+SCORE_WEIGHTS = {
+    '0': 10 ** 10,  # fail
+    '1': 10 ** 10,  # fail
+    **{str(i): 10 ** (8 - i) for i in range(2, 9)},
+}
+
+
 class ScoringError(Exception):
     pass
 
 
-class Scoring:
-    def __init__(self, ipcress_file, mismatches, targeton_csv=None):
-        self._mismatch_df = self.mismatches_to_df(
-            ipcress_file, mismatches, targeton_csv
-        )
-        self._csv = targeton_csv
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=2 ** 30):
+        self._dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._dir.mkdir(exist_ok=True, parents=True)
 
     @staticmethod
-    def mismatches_to_df(ipcress_file, mismatches, targeton_csv=None):
-        mismatch_counts = defaultdict(
-            lambda: {str(i): 0 for i in range(2 * mismatches + 1)}
-        )
-
-        with open(ipcress_file) as ipcress_fh:
-            for line in ipcress_fh:
-                if line == '-- completed ipcress analysis\n':
-                    break
-                exp_id, primer_5, mismatch_5, primer_3, mismatch_3 = (
-                    Scoring._parse_ipcress_line(line, ipcress_file)
-                )
-                total_mismatches = str(int(mismatch_5) + int(mismatch_3))
-                try:
-                    mismatch_counts[(exp_id, primer_5)][mismatch_5] += 1
-                    mismatch_counts[(exp_id, primer_3)][mismatch_3] += 1
-                    mismatch_counts[(exp_id, 'Total')][total_mismatches] += 1
-                except KeyError:
-                    raise ScoringError(
-                        "Mismatch number too low for "
-                        f"ipcress file: '{mismatches}'"
-                    )
+    def key(ipcress_file, mismatches, targeton_csv=None, pairs=None):
+        digest = hashlib.sha256(f'{VERSION}\0{mismatches}\0'.encode())
+        if pairs is not None:
+            digest.update(b'\n'.join(sorted(pairs)) + b'\0')
+        for file_path in (ipcress_file, targeton_csv):
+            if file_path:
+                with open(file_path, 'rb') as fh:
+                    for chunk in iter(lambda: fh.read(2 ** 20), b''):
+                        digest.update(chunk)
+            digest.update(b'\0')
+        return digest.hexdigest()
 
-        df = pd.DataFrame.from_dict(mismatch_counts, orient='index')
-        if df.empty:
-            raise ScoringError(f"No data in ipcress file: '{ipcress_file}'")
-        df.index.set_names(['Primer pair', 'A/B/Total'], inplace=True)
-        if targeton_csv:
-            Scoring._add_targeton_column(df, targeton_csv)
-        df.sort_index(inplace=True)  # order A, B, Total
-        df['WGE format'] = df.apply(lambda row: row.to_dict(), axis=1)
+    def get(self, key):
+        entry = self._dir / f'{key}.pkl'
+        try:
+            os.utime(entry)  # mark as recently used before reading
+            df = pd.read_pickle(entry)
+        except FileNotFoundError:  # missing or evicted by another process
+            return None
+        except (
+                pickle.UnpicklingError, EOFError, OSError, AttributeError,
+                ImportError, IndexError, TypeError, ValueError
+        ):
+            # corrupt, unreadable or written by another pandas version
+            try:
+                entry.unlink()
+            except OSError:
+                pass
+            return None
         return df
 
+    def put(self, key, df):
+        # write then rename so other processes never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                df.to_pickle(fh)
+            os.replace(tmp_path, self._dir / f'{key}.pkl')
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in self._dir.glob('*.pkl'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self._max_bytes:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class ProgressReporter:
+    def __init__(
+            self, interval=10, stream=None,
+            metrics_file=None, prometheus_file=None, quiet=False
+    ):
+        self._interval = interval
+        self._stream = stream
+        self._quiet = quiet
+        self._metrics_file = metrics_file
+        self._prometheus_file = prometheus_file
+        self._total_bytes = 0
+        self._start_time = None
+        self._last_report = None
+
+    def start(self, total_bytes):
+        self._total_bytes = total_bytes
+        self._start_time = self._last_report = time.monotonic()
+
+    def update(self, bytes_read, lines, mismatch_counts=None, done=False):
+        now = time.monotonic()
+        if not done and now - self._last_report < self._interval:
+            return
+        self._last_report = now
+        elapsed = max(now - self._start_time, 1e-9)
+        bytes_per_second = bytes_read / elapsed
+        metrics = {
+            'timestamp': time.time(),
+            'bytes_processed': bytes_read,
+            'total_bytes': self._total_bytes,
+            'lines_processed': lines,
+            'lines_per_second': round(lines / elapsed, 1),
+            # counts flushed in batches only cover the current batch
+            'primer_pairs': sum(
+                1 for _, primer in mismatch_counts if primer == b'Total'
+            ) if mismatch_counts is not None else None,
+            'eta_seconds': round(
+                (self._total_bytes - bytes_read) / bytes_per_second, 1
+            ) if bytes_per_second else None,
+            'rss_bytes': self._current_rss(),
+            'done': done,
+        }
+        self._report(metrics)
+
+    def _report(self, metrics):
+        if not self._quiet:
+            percent = 100 * metrics['bytes_processed'] / max(
+                metrics['total_bytes'], 1
+            )
+            rss = metrics['rss_bytes']
+            pairs = metrics['primer_pairs']
+            print(
+                f"{'Parsed' if metrics['done'] else 'Parsing'}: "
+                f"{percent:.1f}% of {metrics['total_bytes']} bytes, "
+                f"{metrics['lines_processed']} lines "
+                f"({metrics['lines_per_second']:.0f}/s), "
+                f"{'?' if pairs is None else pairs} primer pairs, "
+                f"ETA {metrics['eta_seconds']}s, "
+                f"RSS {rss // 2 ** 20 if rss else '?'} MB",
+                file=self._stream or sys.stderr
+            )
+        if self._metrics_file:
+            with open(self._metrics_file, 'a') as fh:
+                fh.write(json.dumps(metrics) + '\n')
+        if self._prometheus_file:
+            self._write_prometheus(metrics)
+
+    def _write_prometheus(self, metrics):
+        text = ''
+        for name, value in metrics.items():
+            if value is None:
+                continue
+            text += f'sge_primer_scoring_{name} {float(value)}\n'
+        # write then rename so the textfile collector never reads a partial
+        # file
+        tmp_path = f'{self._prometheus_file}.tmp'
+        with open(tmp_path, 'w') as fh:
+            fh.write(text)
+        os.replace(tmp_path, self._prometheus_file)
+
     @staticmethod
-    def _parse_ipcress_line(line, ipcress_file):
-        regex = (
-            r'ipcress: \S+ '  # ipcress: 11:filter(unmasked)
-            r'(\S+) \d+ '  # SMARCA4_exon24_1 204
-            r'([A|B]) \d+ (\d+) '  # A 3231378 4
-            r'([A|B]) \d+ (\d+) '  # A 3231564 4
-            r'[a-zAB_]+\n'  # single_A
-        )
-        valid_line = re.fullmatch(regex, line)
-        if not valid_line:
-            raise ScoringError(f"Invalid ipcress file: '{ipcress_file}'")
-        return valid_line.groups()
+    def _current_rss():
+        try:
+            with open('/proc/self/statm') as fh:
+                pages = int(fh.read().split()[1])
+            return pages * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+
+class Scoring:
+    def __init__(
+            self, ipcress_file, mismatches, targeton_csv=None,
+            cache=None, progress=None, pairs=None, cancel=None
+    ):
+        if cache:
+            key = cache.key(ipcress_file, mismatches, targeton_csv, pairs)
+            self._mismatch_df = cache.get(key)
+            if self._mismatch_df is None:
+                self._mismatch_df = self.mismatches_to_df(
+                    ipcress_file, mismatches, targeton_csv, progress, pairs,
+                    cancel
+                )
+                cache.put(key, self._mismatch_df)
+        else:
+            self._mismatch_df = self.mismatches_to_df(
+                ipcress_file, mismatches, targeton_csv, progress, pairs,
+                cancel
+            )
+        self._csv = targeton_csv
 
     @staticmethod
-    def _add_targeton_column(df, targeton_csv):
-        targetons = defaultdict(str)
-        with open(targeton_csv) as fh:
-            for line in fh:
-                valid_line = re.match(r'^(\S+),(\S+)$', line)
-                if not valid_line:
-                    raise ScoringError(
-                        f"Invalid targeton csv: '{targeton_csv}'"
-                    )
-                primer_pair, targeton = valid_line.groups()
-                if (primer_pair in targetons) and (
-                        targetons[primer_pair] != targeton
-                ):
-                    raise ScoringError(
-                        f"Conflicting entries in targeton csv "
-                        f"for {primer_pair}: '{targeton_csv}'"
-                    )
-                targetons[primer_pair] = targeton
-        df['Targeton'] = df.apply(lambda row: targetons[row.name[0]], axis=1)
-        df.set_index('Targeton', append=True, inplace=True)
-        df.index = df.index.reorder_levels(
-            ['Targeton', 'Primer pair', 'A/B/Total']
+    def mismatches_to_df(
+            ipcress_file, mismatches, targeton_csv=None, progress=None,
+            pairs=None, cancel=None
+    ):
+        mismatch_counts = count_mismatches(
+            ipcress_file, mismatches, progress, pairs=pairs, cancel=cancel
         )
+        df = build_df(
+            mismatch_counts, 2 * mismatches + 1, targeton_csv
+        )
+        df['WGE format'] = df.apply(lambda row: row.to_dict(), axis=1)
+        return df
+
+    @staticmethod
+    def select_pairs(
+            pairs=None, targetons=None, targeton_csv=None,
+            csv_pairs_only=False
+    ):
+        if not (pairs or targetons or csv_pairs_only):
+            return None
+        selected = set(pairs or ())
+        if targetons or csv_pairs_only:
+            if not targeton_csv:
+                raise ScoringError(
+                    'Targeton csv required to select primer pairs '
+                    'by targeton'
+                )
+            csv_targetons = read_targetons(targeton_csv)
+            if csv_pairs_only:
+                selected.update(csv_targetons)
+            if targetons:
+                selected.update(
+                    primer_pair
+                    for primer_pair, targeton in csv_targetons.items()
+                    if targeton in targetons
+                )
+        return {primer_pair.encode() for primer_pair in selected}
 
     @property
     def mismatch_df(self):
         return self._mismatch_df
 
     def add_scores_to_df(self):
-        df = self.mismatch_df
-        df['Score'] = df.apply(self.score_mismatches, axis=1)
-        df['Sum'] = df.groupby('Primer pair')['Score'].transform('sum')
-        if self._csv:
-            df.sort_values(
-                ['Targeton', 'Sum', 'Primer pair', 'A/B/Total'], inplace=True
-            )
-        else:
-            df.sort_values(['Sum', 'Primer pair', 'A/B/Total'], inplace=True)
-        df.drop('Sum', axis=1, inplace=True)
+        score_df(self.mismatch_df, self._csv)
 
     @staticmethod
     def score_mismatches(row):
         if row.name[-1] != 'Total':
             return np.nan
-        weights = {str(i): 10 ** (8 - i) for i in range(2, 9)}
-        weights['0'] = 10 ** 10  # fail
-        weights['1'] = 10 ** 10  # fail
+        weights = SCORE_WEIGHTS
         score = 0
         for col, val in row.items():
             if col not in weights.keys():
@@ -145,3 +305,578 @@ class Scoring:
     def save_mismatches(self, output_file):
         Path(output_file).parent.mkdir(exist_ok=True, parents=True)
         self.mismatch_df.to_csv(output_file, sep='\t')
+
+    def save_partitioned(self, output_dir, buckets=None, workers=None):
+        df = self.mismatch_df
+        if buckets:
+            # crc32 rather than hash() so buckets are stable between runs
+            partitions = df.index.get_level_values('Primer pair').map(
+                lambda pair: f'bucket_{zlib.crc32(pair.encode()) % buckets}'
+            )
+        else:
+            self.check_partition(buckets, self._csv)
+            partitions = df.index.get_level_values('Targeton')
+        groups = list(df.groupby(partitions, sort=True))
+        file_names = {
+            partition: self._partition_file_name(partition)
+            for partition, _ in groups
+        }
+        names = set(file_names.values())
+        if len(names) < len(file_names) or MANIFEST_FILE in names:
+            raise ScoringError('Partitions map to the same file name')
+        output_path = Path(output_dir)
+        output_path.mkdir(exist_ok=True, parents=True)
+        with ThreadPoolExecutor(workers) as executor:
+            manifest = list(executor.map(
+                lambda group: self._save_partition(
+                    output_path, file_names[group[0]], *group
+                ),
+                groups
+            ))
+        manifest_file = output_path / MANIFEST_FILE
+        pd.DataFrame(manifest).to_csv(manifest_file, sep='\t', index=False)
+        return manifest_file
+
+    @staticmethod
+    def check_partition(buckets=None, targeton_csv=None):
+        if not (buckets or targeton_csv):
+            raise ScoringError(
+                'Targeton csv or number of buckets required '
+                'to partition output'
+            )
+
+    @staticmethod
+    def _partition_file_name(partition):
+        name = re.sub(r'[^\w.-]', '_', partition)
+        if name != partition or not name or (
+                f'{name}.tsv'.lower() == MANIFEST_FILE
+        ):
+            # keep names that had to be changed (or were empty, for pairs
+            # missing from the targeton csv, or would overwrite the
+            # manifest) apart from each other
+            digest = hashlib.sha256(partition.encode()).hexdigest()[:8]
+            name = f'{name}_{digest}'
+        return f'{name}.tsv'
+
+    @staticmethod
+    def _save_partition(output_path, file_name, partition, df):
+        data = df.to_csv(sep='\t').encode()
+        with open(output_path / file_name, 'wb') as fh:
+            fh.write(data)
+        return {
+            'Partition': partition,
+            'File': file_name,
+            'Rows': len(df),
+            'SHA256': hashlib.sha256(data).hexdigest(),
+        }
+
+
+def read_targetons(targeton_csv):
+    targetons = {}
+    with open(targeton_csv) as fh:
+        for line in fh:
+            valid_line = re.match(r'^(\S+),(\S+)$', line)
+            if not valid_line:
+                raise ScoringError(
+                    f"Invalid targeton csv: '{targeton_csv}'"
+                )
+            primer_pair, targeton = valid_line.groups()
+            if (primer_pair in targetons) and (
+                    targetons[primer_pair] != targeton
+            ):
+                raise ScoringError(
+                    f"Conflicting entries in targeton csv "
+                    f"for {primer_pair}: '{targeton_csv}'"
+                )
+            targetons[primer_pair] = targeton
+    return targetons
+
+
+def _add_targeton_column(df, targeton_csv):
+    targetons = defaultdict(str, read_targetons(targeton_csv))
+    df['Targeton'] = df.apply(lambda row: targetons[row.name[0]], axis=1)
+    df.set_index('Targeton', append=True, inplace=True)
+    df.index = df.index.reorder_levels(
+        ['Targeton', 'Primer pair', 'A/B/Total']
+    )
+
+
+def count_mismatches(
+        ipcress_file, mismatches, progress=None, joint_counts=None,
+        flush=None, pairs=None, cancel=None
+):
+    columns = 2 * mismatches + 1
+    mismatch_counts = defaultdict(lambda: [0] * columns)
+    # map digits straight from bytes, without decoding every line
+    values = {str(i).encode(): i for i in range(columns)}
+
+    # per-primer counts are only reported while they are all kept
+    reported = None if flush or joint_counts is not None else mismatch_counts
+
+    lines = counted_lines = 0
+    with open(ipcress_file, 'rb') as ipcress_fh:
+        buffer = _map_file(ipcress_fh)
+        if progress:
+            progress.start(len(buffer))
+        try:
+            for lines, (position, valid_line) in enumerate(
+                _scan_ipcress(buffer, ipcress_file, pairs), 1
+            ):
+                if (progress or flush or cancel) and (
+                        not lines % PROGRESS_LINES
+                ):
+                    if cancel:
+                        check_cancelled(cancel)
+                    if progress:
+                        progress.update(position, lines, reported)
+                    if flush:  # hand over counts in batches
+                        flush(mismatch_counts)
+                        mismatch_counts.clear()
+                if valid_line is None:  # primer pair not selected
+                    continue
+                counted_lines += 1
+                exp_id, primer_5, mismatch_5, primer_3, mismatch_3 = (
+                    valid_line.groups()
+                )
+                try:
+                    mismatch_5 = values[mismatch_5]
+                    mismatch_3 = values[mismatch_3]
+                    if joint_counts is not None:
+                        # per-primer counts can be rebuilt from these
+                        joint_counts[exp_id][
+                            primer_5, mismatch_5, primer_3, mismatch_3
+                        ] += 1
+                        continue
+                    mismatch_counts[exp_id, primer_5][mismatch_5] += 1
+                    mismatch_counts[exp_id, primer_3][mismatch_3] += 1
+                    mismatch_counts[exp_id, b'Total'][
+                        mismatch_5 + mismatch_3
+                    ] += 1
+                except (KeyError, IndexError):
+                    raise ScoringError(
+                        "Mismatch number too low for "
+                        f"ipcress file: '{mismatches}'"
+                    )
+            if progress:
+                progress.update(len(buffer), lines, reported, done=True)
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+
+    if not lines:
+        raise ScoringError(f"No data in ipcress file: '{ipcress_file}'")
+    if not counted_lines:
+        raise ScoringError(
+            "No data for selected primer pairs in "
+            f"ipcress file: '{ipcress_file}'"
+        )
+    if flush:
+        flush(mismatch_counts)
+        mismatch_counts.clear()
+    return mismatch_counts
+
+
+def check_cancelled(cancel):
+    if cancel.is_set():
+        raise ScoringError('Scoring cancelled')
+
+
+def _map_file(fh):
+    try:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # empty files and file objects without a real descriptor
+        # cannot be mapped
+        return fh.read()
+
+
+def _scan_ipcress(buffer, ipcress_file, pairs=None):
+    position = 0
+    end = len(buffer)
+    while position < end:
+        if pairs is not None:
+            # skip other primer pairs before parsing the whole line
+            pair = IPCRESS_PAIR.match(buffer, position)
+            if pair and pair.group(1) not in pairs:
+                position = buffer.find(b'\n', pair.end()) + 1 or end
+                yield position, None
+                continue
+        valid_line = IPCRESS_LINE.match(buffer, position)
+        if not valid_line:
+            if IPCRESS_END.match(buffer, position):
+                break
+            raise ScoringError(f"Invalid ipcress file: '{ipcress_file}'")
+        position = valid_line.end()
+        yield position, valid_line
+
+
+def _counts_to_df(mismatch_counts, columns):
+    names = {}  # decode each primer pair name only once
+    index = []
+    for exp_id, primer in mismatch_counts.keys():
+        if exp_id not in names:
+            names[exp_id] = exp_id.decode()
+        index.append((names[exp_id], primer.decode()))
+    return pd.DataFrame(
+        list(mismatch_counts.values()),
+        index=pd.MultiIndex.from_tuples(
+            index, names=['Primer pair', 'A/B/Total']
+        ),
+        columns=[str(i) for i in range(columns)]
+    )
+
+
+def build_df(mismatch_counts, columns, targeton_csv=None):
+    df = _counts_to_df(mismatch_counts, columns)
+    if targeton_csv:
+        _add_targeton_column(df, targeton_csv)
+    df.sort_index(inplace=True)  # order A, B, Total
+    return df
+
+
+def score_df(df, targeton_csv=None):
+    df['Score'] = df.apply(Scoring.score_mismatches, axis=1)
+    df['Sum'] = df.groupby('Primer pair')['Score'].transform('sum')
+    if targeton_csv:
+        df.sort_values(
+            ['Targeton', 'Sum', 'Primer pair', 'A/B/Total'], inplace=True
+        )
+    else:
+        df.sort_values(['Sum', 'Primer pair', 'A/B/Total'], inplace=True)
+    df.drop('Sum', axis=1, inplace=True)
+
+
+class ThresholdSweep:
+    def __init__(
+            self, ipcress_file, mismatches, thresholds,
+            targeton_csv=None, progress=None, pairs=None
+    ):
+        for threshold in thresholds:
+            if threshold > mismatches:
+                raise ScoringError(
+                    "Sweep threshold higher than "
+                    f"mismatch number: '{threshold}'"
+                )
+        self._thresholds = sorted(set(thresholds))
+        self._csv = targeton_csv
+        # one pass at the full mismatch number, keeping the mismatches of
+        # both primers together so hits can be filtered for any threshold
+        joint_counts = defaultdict(lambda: defaultdict(int))
+        count_mismatches(
+            ipcress_file, mismatches, progress, joint_counts, pairs=pairs
+        )
+        self._sweep_df = self._scores_by_threshold(joint_counts)
+        self._stability_df = self._rank_stability()
+
+    @staticmethod
+    def counts_at_threshold(joint_counts, threshold):
+        columns = 2 * threshold + 1
+        mismatch_counts = defaultdict(lambda: [0] * columns)
+        for exp_id, hits in joint_counts.items():
+            for (primer_5, mismatch_5, primer_3, mismatch_3), count in (
+                hits.items()
+            ):
+                if mismatch_5 > threshold or mismatch_3 > threshold:
+                    continue
+                mismatch_counts[exp_id, primer_5][mismatch_5] += count
+                mismatch_counts[exp_id, primer_3][mismatch_3] += count
+                mismatch_counts[exp_id, b'Total'][
+                    mismatch_5 + mismatch_3
+                ] += count
+        return mismatch_counts
+
+    def _scores_by_threshold(self, joint_counts):
+        columns = {}
+        for threshold in self._thresholds:
+            df = build_df(
+                self.counts_at_threshold(joint_counts, threshold),
+                2 * threshold + 1, self._csv
+            )
+            score_df(df, self._csv)
+            scores = df.xs('Total', level='A/B/Total')['Score']
+            if self._csv:
+                ranks = scores.groupby(level='Targeton').rank(method='min')
+            else:
+                ranks = scores.rank(method='min')
+            columns[f'Score ({threshold})'] = scores
+            columns[f'Rank ({threshold})'] = ranks.astype(int)
+        df = pd.DataFrame(columns)
+        top = self._thresholds[-1]
+        sort_by = [f'Rank ({top})', 'Primer pair']
+        if self._csv:
+            sort_by.insert(0, 'Targeton')
+        return df.sort_values(sort_by)
+
+    def _rank_stability(self):
+        top = self._thresholds[-1]
+        if self._csv:
+            groups = self._sweep_df.groupby(level='Targeton')
+        else:
+            groups = [('All', self._sweep_df)]
+        rows = {}
+        for targeton, group in groups:
+            top_scores = group[f'Score ({top})']
+            row = {'Primer pairs': len(group)}
+            for threshold in self._thresholds[:-1]:
+                scores = group[f'Score ({threshold})']
+                ranks = group[f'Rank ({threshold})']
+                row[f'Spearman ({threshold})'] = np.nan  # all scores tied
+                if scores.nunique() > 1 and top_scores.nunique() > 1:
+                    row[f'Spearman ({threshold})'] = (
+                        scores.rank().corr(top_scores.rank())
+                    )
+                row[f'Mean rank change ({threshold})'] = (
+                    (ranks - group[f'Rank ({top})']).abs().mean()
+                )
+                # compare all pairs sharing the best rank, not just one
+                top_pairs = set(group.index[ranks == 1])
+                row[f'Same top pair ({threshold})'] = top_pairs == set(
+                    group.index[group[f'Rank ({top})'] == 1]
+                )
+            rows[targeton] = row
+        df = pd.DataFrame.from_dict(rows, orient='index')
+        df.index.set_names('Targeton', inplace=True)
+        return df
+
+    @property
+    def sweep_df(self):
+        return self._sweep_df
+
+    @property
+    def stability_df(self):
+        return self._stability_df
+
+    def save_sweep(self, output_file):
+        output_path = Path(output_file)
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        self.sweep_df.to_csv(output_path, sep='\t')
+        stability_path = output_path.with_name(
+            f'{output_path.stem}_stability{output_path.suffix}'
+        )
+        self.stability_df.to_csv(stability_path, sep='\t')
+        return stability_path
+
+
+class CountStore:
+    def __init__(self, db_path, mismatches):
+        Path(db_path).parent.mkdir(exist_ok=True, parents=True)
+        self._conn = sqlite3.connect(db_path)
+        self._mismatches = mismatches
+        with self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS counts (
+                    primer_pair TEXT, primer TEXT, mismatch INTEGER,
+                    count INTEGER,
+                    PRIMARY KEY (primer_pair, primer, mismatch)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS targetons (
+                    primer_pair TEXT PRIMARY KEY, targeton TEXT
+                );
+                CREATE INDEX IF NOT EXISTS targeton_index
+                    ON targetons (targeton);
+                CREATE TABLE IF NOT EXISTS shards (
+                    sha256 TEXT PRIMARY KEY, ipcress_file TEXT
+                );
+                CREATE TABLE IF NOT EXISTS weights (
+                    mismatch INTEGER PRIMARY KEY, weight INTEGER
+                );
+            ''')
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO weights VALUES (?, ?)',
+                [(int(col), weight) for col, weight in SCORE_WEIGHTS.items()]
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('mismatches', ?)",
+                (mismatches,)
+            )
+        stored, = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'mismatches'"
+        ).fetchone()
+        if stored != mismatches:
+            self._conn.close()
+            raise ScoringError(
+                f"Mismatch number does not match count store: '{mismatches}'"
+            )
+
+    def add_ipcress(self, ipcress_file, progress=None, pairs=None):
+        digest = hashlib.sha256()
+        with open(ipcress_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(2 ** 20), b''):
+                digest.update(chunk)
+        with self._conn:  # roll back the whole shard if it is invalid
+            try:
+                self._conn.execute(
+                    'INSERT INTO shards VALUES (?, ?)',
+                    (digest.hexdigest(), str(ipcress_file))
+                )
+            except sqlite3.IntegrityError:
+                raise ScoringError(
+                    "ipcress file already added to "
+                    f"count store: '{ipcress_file}'"
+                )
+            count_mismatches(
+                ipcress_file, self._mismatches, progress,
+                flush=self._upsert_counts, pairs=pairs
+            )
+
+    def _upsert_counts(self, mismatch_counts):
+        self._conn.executemany(
+            'INSERT INTO counts VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (primer_pair, primer, mismatch) '
+            'DO UPDATE SET count = count + excluded.count',
+            (
+                (exp_id.decode(), primer.decode(), mismatch, count)
+                for (exp_id, primer), counts in mismatch_counts.items()
+                for mismatch, count in enumerate(counts) if count
+            )
+        )
+
+    def add_targetons(self, targeton_csv):
+        targetons = read_targetons(targeton_csv)
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO targetons VALUES (?, ?)',
+                targetons.items()
+            )
+
+    @property
+    def has_targetons(self):
+        has_targetons, = self._conn.execute(
+            'SELECT EXISTS (SELECT 1 FROM targetons)'
+        ).fetchone()
+        return bool(has_targetons)
+
+    def header(self):
+        header = ['Primer pair', 'A/B/Total']
+        if self.has_targetons:
+            header.insert(0, 'Targeton')
+        columns = [str(i) for i in range(2 * self._mismatches + 1)]
+        return header + columns + ['WGE format', 'Score']
+
+    def rows(self, targeton=None):
+        pair_filter, params = '', ()
+        if targeton is not None:
+            pair_filter = (
+                'AND primer_pair IN '
+                '(SELECT primer_pair FROM targetons WHERE targeton = ?)'
+            )
+            params = (targeton,)
+        scores = f'''
+            WITH scores AS (
+                SELECT primer_pair,
+                    SUM(count * COALESCE(weight, 0)) - {SCORE_WEIGHTS['0']}
+                        AS score,
+                    SUM(CASE WHEN mismatch = 0 THEN count ELSE 0 END)
+                        AS on_target
+                FROM counts LEFT JOIN weights USING (mismatch)
+                WHERE primer = 'Total' {pair_filter}
+                GROUP BY primer_pair
+            )
+        '''
+        missing = self._conn.execute(
+            f'{scores} SELECT primer_pair FROM scores '
+            'WHERE on_target = 0 ORDER BY primer_pair LIMIT 1',
+            params
+        ).fetchone()
+        if missing:
+            raise ScoringError(f'No on-target hit found for {missing[0]}')
+        cursor = self._conn.execute(
+            f'''{scores}
+            SELECT COALESCE(targeton, ''), primer_pair, primer, mismatch,
+                count, score
+            FROM counts
+                JOIN scores USING (primer_pair)
+                LEFT JOIN targetons USING (primer_pair)
+            ORDER BY 1, score, primer_pair, primer, mismatch
+            ''',
+            params
+        )
+        with_targeton = self.has_targetons
+        row_key, counts, score = None, None, None
+        for targeton_name, exp_id, primer, mismatch, count, pair_score in (
+            cursor
+        ):
+            key = (targeton_name, exp_id, primer)
+            if key != row_key:
+                if row_key:
+                    yield self._format_row(
+                        row_key, counts, score, with_targeton
+                    )
+                row_key = key
+                counts = [0] * (2 * self._mismatches + 1)
+                score = pair_score
+            counts[mismatch] = count
+        if row_key:
+            yield self._format_row(row_key, counts, score, with_targeton)
+
+    @staticmethod
+    def _format_row(row_key, counts, score, with_targeton):
+        targeton, exp_id, primer = row_key
+        row = [targeton] if with_targeton else []
+        row += [exp_id, primer, *counts]
+        row.append({str(i): count for i, count in enumerate(counts)})
+        row.append(float(score) if primer == 'Total' else None)
+        return row
+
+    def write_tsv(self, output_file, targeton=None):
+        Path(output_file).parent.mkdir(exist_ok=True, parents=True)
+        with open(output_file, 'w', newline='') as fh:
+            writer = csv.writer(fh, delimiter='\t', lineterminator='\n')
+            writer.writerow(self.header())
+            writer.writerows(self.rows(targeton))
+
+    def targeton_df(self, targeton):
+        header = self.header()
+        df = pd.DataFrame(list(self.rows(targeton)), columns=header)
+        df['Score'] = df['Score'].astype(float)
+        return df.set_index(header[:header.index('A/B/Total') + 1])
+
+    def close(self):
+        self._conn.close()
+
+
+def _score(
+        ipcress_file, mismatches, targeton_csv=None,
+        output_file=None, cache=None, cancel=None
+):
+    scoring = Scoring(
+        ipcress_file, mismatches, targeton_csv, cache, cancel=cancel
+    )
+    if cancel:
+        check_cancelled(cancel)
+    scoring.add_scores_to_df()
+    if output_file:
+        if cancel:
+            check_cancelled(cancel)
+        scoring.save_mismatches(output_file)
+    return scoring
+
+
+async def score_async(
+        ipcress_file, mismatches, targeton_csv=None,
+        output_file=None, cache=None, executor=None, timeout=None,
+        manager=None
+):
+    loop = asyncio.get_running_loop()
+    if manager:
+        cancel = manager.Event()
+    elif isinstance(executor, ProcessPoolExecutor):
+        # worker processes cannot share a threading.Event
+        cancel = None
+    else:
+        cancel = threading.Event()
+    future = loop.run_in_executor(
+        executor, _score,
+        ipcress_file, mismatches, targeton_csv, output_file, cache, cancel
+    )
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # a queued job is cancelled with the future, a running one stops at
+        # its next check and frees its worker without saving output
+        if cancel:
+            cancel.set()
+        raise
@@ -15,10 +15,16 @@
 
 
 import argparse
+import io
+from unittest.mock import patch
 
 from pyfakefs.fake_filesystem_unittest import TestCase
 
-from score_primers import positive_int, non_empty_file, new_file_path
+from score_primers import (
+    positive_int, positive_size, positive_interval, non_empty_file,
+    new_file_path, threshold_list, name_list, partition_mode,
+    parse_arguments
+)
 
 
 class TestScorePrimers(TestCase):
@@ -98,6 +104,144 @@ class TestScorePrimers(TestCase):
         # assert
         self.assertEqual(str(cm.exception), expected)
 
+    def test_positive_size_positive_arg_success(self):
+        # arrange
+        test_arg = '10'
+        expected = 10
+
+        # act
+        actual = positive_size(test_arg)
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_positive_size_zero_arg_fail(self):
+        # arrange
+        test_arg = '0'
+        expected = 'Size must be greater than zero'
+
+        # act
+        with self.assertRaises(argparse.ArgumentTypeError) as cm:
+            positive_size(test_arg)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_positive_interval_fractional_arg_success(self):
+        # arrange
+        test_arg = '0.5'
+        expected = 0.5
+
+        # act
+        actual = positive_interval(test_arg)
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_positive_interval_zero_arg_fail(self):
+        # arrange
+        test_arg = '0'
+        expected = 'Progress interval must be greater than zero'
+
+        # act
+        with self.assertRaises(argparse.ArgumentTypeError) as cm:
+            positive_interval(test_arg)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_threshold_list_valid_list_success(self):
+        # arrange
+        test_arg = '2,3,4'
+        expected = [2, 3, 4]
+
+        # act
+        actual = threshold_list(test_arg)
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_threshold_list_invalid_list_fail(self):
+        # arrange
+        test_arg = '2;3'
+        expected = "Invalid list of mismatch numbers: '2;3'"
+
+        # act
+        with self.assertRaises(argparse.ArgumentTypeError) as cm:
+            threshold_list(test_arg)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_threshold_list_negative_number_fail(self):
+        # arrange
+        test_arg = '2,-1'
+        expected = 'Mismatch number cannot be negative'
+
+        # act
+        with self.assertRaises(argparse.ArgumentTypeError) as cm:
+            threshold_list(test_arg)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_name_list_valid_list_success(self):
+        # arrange
+        test_arg = 'pair_1,pair_2'
+        expected = {'pair_1', 'pair_2'}
+
+        # act
+        actual = name_list(test_arg)
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_name_list_empty_name_fail(self):
+        # arrange
+        test_arg = 'pair_1,'
+        expected = "Invalid list of names: 'pair_1,'"
+
+        # act
+        with self.assertRaises(argparse.ArgumentTypeError) as cm:
+            name_list(test_arg)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_partition_mode_targeton_success(self):
+        # arrange
+        test_arg = 'targeton'
+        expected = 'targeton'
+
+        # act
+        actual = partition_mode(test_arg)
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_partition_mode_buckets_success(self):
+        # arrange
+        test_arg = '16'
+        expected = 16
+
+        # act
+        actual = partition_mode(test_arg)
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_partition_mode_invalid_fail(self):
+        # arrange
+        test_arg = '0'
+        expected = "Partition must be 'targeton' or a number of buckets: '0'"
+
+        # act
+        with self.assertRaises(argparse.ArgumentTypeError) as cm:
+            partition_mode(test_arg)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
     def test_new_file_path_new_file_path_success(self):
         # arrange
         test_arg = 'new_file.txt'
@@ -144,3 +288,22 @@ class TestScorePrimers(TestCase):
 
         # assert
         self.assertEqual(str(cm.exception), expected)
+
+    def test_parse_arguments_cache_dir_with_count_store_fail(self):
+        # arrange
+        argv = [
+            'score_primers.py', 'non_empty_file.txt', '2', 'output.tsv',
+            '--count_store', 'counts.db', '--cache_dir', 'cache'
+        ]
+        expected = (
+            'argument --cache_dir: not allowed with argument --count_store'
+        )
+
+        # act
+        with patch('sys.argv', argv), \
+                patch('sys.stderr', new_callable=io.StringIO) as stderr, \
+                self.assertRaises(SystemExit):
+            parse_arguments()
+
+        # assert
+        self.assertIn(expected, stderr.getvalue())
@@ -14,14 +14,29 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-from unittest.mock import patch
+from unittest import TestCase as RealFileTestCase
+from unittest.mock import patch, Mock
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+import asyncio
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+import threading
 
 import pandas as pd
 import numpy as np
 from pyfakefs.fake_filesystem_unittest import TestCase
 
-from scoring import Scoring, ScoringError
+import scoring
+from scoring import (
+    Scoring, ScoringError, ResultCache, ProgressReporter, ThresholdSweep,
+    CountStore, score_async, count_mismatches
+)
 
 
 class TestScoring(TestCase):
@@ -130,6 +145,19 @@ class TestScoring(TestCase):
         # assert
         pd.testing.assert_frame_equal(actual, expected)
 
+    def test_mismatches_to_df_crlf_line_endings_success(self):
+        # arrange
+        with open('/ipcress.txt') as f:
+            file_contents = f.read().replace('\n', '\r\n')
+        self.fs.create_file('/crlf.txt', contents=file_contents)
+        expected = self.df
+
+        # act
+        actual = Scoring.mismatches_to_df('/crlf.txt', 2)
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
     def test_mismatches_to_df_invalid_ipcress_file_fail(self):
         # arrange
         self.fs.create_file('/invalid.txt', contents='invalid')
@@ -197,6 +225,649 @@ class TestScoring(TestCase):
         # assert
         self.assertEqual(str(cm.exception), expected)
 
+    def test_result_cache_key_same_for_same_content(self):
+        # arrange
+        with open('/ipcress.txt') as f:
+            self.fs.create_file('/copy.txt', contents=f.read())
+        expected = ResultCache.key('/ipcress.txt', 2, '/targetons.csv')
+
+        # act
+        actual = ResultCache.key('/copy.txt', 2, '/targetons.csv')
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_result_cache_key_differs_by_mismatches(self):
+        # act
+        key_2 = ResultCache.key('/ipcress.txt', 2)
+        key_3 = ResultCache.key('/ipcress.txt', 3)
+
+        # assert
+        self.assertNotEqual(key_2, key_3)
+
+    def test_result_cache_key_differs_by_pairs(self):
+        # act
+        key_all = ResultCache.key('/ipcress.txt', 2)
+        key_pairs = ResultCache.key('/ipcress.txt', 2, pairs={b'pair'})
+
+        # assert
+        self.assertNotEqual(key_all, key_pairs)
+
+    def test_result_cache_get_missing_key_returns_none(self):
+        # act
+        actual = ResultCache('/cache').get('missing')
+
+        # assert
+        self.assertIsNone(actual)
+
+    def test_result_cache_put_then_get_success(self):
+        # arrange
+        cache = ResultCache('/cache')
+        expected = self.df
+
+        # act
+        cache.put('key', self.df)
+        actual = cache.get('key')
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_result_cache_corrupt_entry_is_miss(self):
+        # arrange
+        self.fs.create_file('/cache/key.pkl', contents='truncated')
+
+        # act
+        actual = ResultCache('/cache').get('key')
+
+        # assert
+        self.assertIsNone(actual)
+        self.assertFalse(path.exists('/cache/key.pkl'))
+
+    def test_result_cache_failed_put_removes_temp_file(self):
+        # arrange
+        cache = ResultCache('/cache')
+
+        # act
+        with patch.object(
+                pd.DataFrame, 'to_pickle', side_effect=OSError('disk full')
+        ):
+            with self.assertRaises(OSError):
+                cache.put('key', self.df)
+
+        # assert
+        self.assertEqual(os.listdir('/cache'), [])
+
+    def test_result_cache_evicts_least_recently_used(self):
+        # arrange
+        cache = ResultCache('/cache')
+        cache.put('old', self.df)
+        cache.put('new', self.df)
+        path_old = '/cache/old.pkl'
+        entry_size = path.getsize(path_old)
+        cache = ResultCache('/cache', max_bytes=2 * entry_size)
+        self.fs.utime(path_old, (0, 0))
+
+        # act
+        cache.put('newest', self.df)
+
+        # assert
+        self.assertFalse(path.exists(path_old))
+        self.assertTrue(path.exists('/cache/new.pkl'))
+        self.assertTrue(path.exists('/cache/newest.pkl'))
+
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_scoring_cache_hit_skips_parsing(self, mock_mismatches_to_df):
+        # arrange
+        mock_mismatches_to_df.return_value = self.df
+        cache = ResultCache('/cache')
+        Scoring('/ipcress.txt', 2, cache=cache)
+
+        # act
+        actual = Scoring('/ipcress.txt', 2, cache=cache).mismatch_df
+
+        # assert
+        mock_mismatches_to_df.assert_called_once()
+        pd.testing.assert_frame_equal(actual, self.df)
+
+    @patch('scoring.PROGRESS_LINES', 2)
+    def test_mismatches_to_df_reports_progress(self):
+        # arrange
+        progress = Mock()
+        expected_total = path.getsize('/ipcress.txt')
+
+        # act
+        Scoring.mismatches_to_df('/ipcress.txt', 2, progress=progress)
+
+        # assert
+        progress.start.assert_called_once_with(expected_total)
+        self.assertEqual(progress.update.call_count, 4)
+        args, kwargs = progress.update.call_args
+        self.assertEqual(args[:2], (expected_total, 6))
+        self.assertTrue(kwargs['done'])
+
+    @patch('scoring.PROGRESS_LINES', 2)
+    def test_count_store_progress_leaves_out_primer_pairs(self):
+        # arrange
+        progress = Mock()
+
+        # act
+        CountStore(':memory:', 2).add_ipcress('/ipcress.txt', progress)
+
+        # assert
+        for args, kwargs in progress.update.call_args_list:
+            self.assertIsNone(args[2])
+
+    def test_progress_reporter_unknown_primer_pairs(self):
+        # arrange
+        stream = io.StringIO()
+        progress = ProgressReporter(stream=stream)
+        progress.start(100)
+
+        # act
+        progress.update(100, 10, done=True)
+
+        # assert
+        self.assertIn('? primer pairs', stream.getvalue())
+
+    def test_progress_reporter_resolves_stderr_when_reporting(self):
+        # arrange
+        progress = ProgressReporter()
+        progress.start(100)
+
+        # act
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            progress.update(100, 10, done=True)
+
+        # assert
+        self.assertIn('Parsed: 100.0%', stderr.getvalue())
+
+    def test_progress_reporter_quiet_skips_stream(self):
+        # arrange
+        progress = ProgressReporter(quiet=True)
+        progress.start(100)
+
+        # act
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            progress.update(100, 10, done=True)
+
+        # assert
+        self.assertEqual(stderr.getvalue(), '')
+
+    @patch('scoring.PROGRESS_LINES', 2)
+    def test_mismatches_to_df_progress_counts_skipped_lines(self):
+        # arrange
+        progress = Mock()
+
+        # act
+        Scoring.mismatches_to_df(
+            '/ipcress.txt', 2, progress=progress, pairs={b'BRCA1_exon1_1'}
+        )
+
+        # assert
+        self.assertEqual(progress.update.call_count, 4)
+        args, kwargs = progress.update.call_args
+        self.assertEqual(args[1], 6)
+
+    def test_progress_reporter_skips_update_within_interval(self):
+        # arrange
+        stream = io.StringIO()
+        progress = ProgressReporter(interval=60, stream=stream)
+        progress.start(100)
+
+        # act
+        progress.update(50, 10, {(b'pair', b'Total'): [1]})
+
+        # assert
+        self.assertEqual(stream.getvalue(), '')
+
+    def test_progress_reporter_writes_metrics_file(self):
+        # arrange
+        progress = ProgressReporter(
+            interval=60, metrics_file='/metrics.jsonl', quiet=True
+        )
+        progress.start(100)
+        mismatch_counts = {
+            (b'pair_1', b'A'): [1], (b'pair_1', b'Total'): [1],
+            (b'pair_2', b'Total'): [1],
+        }
+
+        # act
+        progress.update(100, 10, mismatch_counts, done=True)
+        with open('/metrics.jsonl') as f:
+            actual = json.loads(f.readline())
+
+        # assert
+        self.assertEqual(actual['bytes_processed'], 100)
+        self.assertEqual(actual['lines_processed'], 10)
+        self.assertEqual(actual['primer_pairs'], 2)
+        self.assertTrue(actual['done'])
+
+    def test_threshold_sweep_counts_at_full_threshold_match_parse(self):
+        # arrange
+        joint_counts = defaultdict(lambda: defaultdict(int))
+        expected = count_mismatches('/ipcress.txt', 2)
+
+        # act
+        count_mismatches('/ipcress.txt', 2, joint_counts=joint_counts)
+        actual = ThresholdSweep.counts_at_threshold(joint_counts, 2)
+
+        # assert
+        self.assertEqual(dict(actual), dict(expected))
+
+    def test_threshold_sweep_scores_and_ranks_each_threshold(self):
+        # arrange
+        index = pd.Index([
+            'BRCA1_exon1_1', 'SMARCA4_exon24_3', 'SMARCA4_exon24_1'
+        ], name='Primer pair')
+        expected = pd.DataFrame({
+            'Score (1)': [0.0, 0.0, 0.0],
+            'Rank (1)': [1, 1, 1],
+            'Score (2)': [0.0, 100000.0, 110000.0],
+            'Rank (2)': [1, 2, 3],
+        }, index=index)
+
+        # act
+        actual = ThresholdSweep('/ipcress.txt', 2, [2, 1]).sweep_df
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_threshold_sweep_rank_stability_by_targeton(self):
+        # arrange
+        index = pd.Index(['Targeton_1', 'Targeton_2'], name='Targeton')
+        expected = pd.DataFrame({
+            'Primer pairs': [2, 1],
+            'Spearman (1)': [np.nan, np.nan],
+            'Mean rank change (1)': [0.5, 0.0],
+            'Same top pair (1)': [False, True],
+        }, index=index)
+
+        # act
+        actual = ThresholdSweep(
+            '/ipcress.txt', 2, [1, 2], '/targetons.csv'
+        ).stability_df
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_threshold_sweep_threshold_too_high_fail(self):
+        # arrange
+        expected = "Sweep threshold higher than mismatch number: '3'"
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            ThresholdSweep('/ipcress.txt', 2, [1, 3])
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_threshold_sweep_saves_stability_file(self):
+        # act
+        actual = ThresholdSweep('/ipcress.txt', 2, [1, 2]).save_sweep(
+            '/sweep/output.tsv'
+        )
+
+        # assert
+        self.assertEqual(str(actual), '/sweep/output_stability.tsv')
+        self.assertTrue(path.exists('/sweep/output.tsv'))
+        self.assertTrue(path.exists('/sweep/output_stability.tsv'))
+
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_save_partitioned_one_file_per_targeton(
+            self, mock_mismatches_to_df
+    ):
+        # arrange
+        mock_mismatches_to_df.return_value = self.targeton_df
+        expected = pd.DataFrame({
+            'Partition': ['Targeton_1', 'Targeton_2'],
+            'File': ['Targeton_1.tsv', 'Targeton_2.tsv'],
+            'Rows': [6, 3],
+        })
+
+        # act
+        Scoring('/ipcress.txt', 2, '/targetons.csv').save_partitioned('/out')
+        actual = pd.read_csv('/out/manifest.tsv', sep='\t')
+
+        # assert
+        pd.testing.assert_frame_equal(actual.drop('SHA256', axis=1), expected)
+        for file_name, checksum in zip(actual['File'], actual['SHA256']):
+            with open(f'/out/{file_name}', 'rb') as f:
+                actual_checksum = hashlib.sha256(f.read()).hexdigest()
+            self.assertEqual(actual_checksum, checksum)
+
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_save_partitioned_unique_file_names(self, mock_mismatches_to_df):
+        # arrange
+        targetons = {
+            'SMARCA4_exon24_1': 'T/1',
+            'SMARCA4_exon24_3': 'T?1',
+            'BRCA1_exon1_1': 'T_1',
+        }
+        df = self.targeton_df.reset_index()
+        df['Targeton'] = df['Primer pair'].map(targetons)
+        mock_mismatches_to_df.return_value = df.set_index(
+            ['Targeton', 'Primer pair', 'A/B/Total']
+        )
+
+        # act
+        Scoring('/ipcress.txt', 2, '/targetons.csv').save_partitioned('/out')
+        manifest = pd.read_csv('/out/manifest.tsv', sep='\t')
+
+        # assert
+        self.assertEqual(len(set(manifest['File'])), 3)
+        self.assertIn('T_1.tsv', list(manifest['File']))
+        for partition, file_name in zip(
+                manifest['Partition'], manifest['File']
+        ):
+            actual = pd.read_csv(f'/out/{file_name}', sep='\t')
+            self.assertEqual(set(actual['Targeton']), {partition})
+            self.assertEqual(len(actual), 3)
+
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_save_partitioned_targeton_named_manifest(
+            self, mock_mismatches_to_df
+    ):
+        # arrange
+        df = self.targeton_df.reset_index()
+        df['Targeton'] = 'manifest'
+        mock_mismatches_to_df.return_value = df.set_index(
+            ['Targeton', 'Primer pair', 'A/B/Total']
+        )
+
+        # act
+        Scoring('/ipcress.txt', 2, '/targetons.csv').save_partitioned('/out')
+        manifest = pd.read_csv('/out/manifest.tsv', sep='\t')
+
+        # assert
+        self.assertEqual(list(manifest['Partition']), ['manifest'])
+        file_name = manifest['File'][0]
+        self.assertNotEqual(file_name, 'manifest.tsv')
+        actual = pd.read_csv(f'/out/{file_name}', sep='\t')
+        self.assertEqual(len(actual), manifest['Rows'][0])
+
+    def test_check_partition_targeton_without_csv_fail(self):
+        # arrange
+        expected = (
+            'Targeton csv or number of buckets required to partition output'
+        )
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring.check_partition()
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_check_partition_buckets_without_csv_success(self):
+        # act
+        Scoring.check_partition(buckets=4)
+
+    def test_partition_file_name_empty_differs_from_underscore(self):
+        # act
+        empty = Scoring._partition_file_name('')
+        underscore = Scoring._partition_file_name('_')
+
+        # assert
+        self.assertNotEqual(empty, underscore)
+        self.assertEqual(underscore, '_.tsv')
+
+    @patch('scoring.Scoring._partition_file_name', return_value='same.tsv')
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_save_partitioned_file_name_collision_fail(
+            self, mock_mismatches_to_df, mock_file_name
+    ):
+        # arrange
+        mock_mismatches_to_df.return_value = self.targeton_df
+        expected = 'Partitions map to the same file name'
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring('/ipcress.txt', 2, '/targetons.csv').save_partitioned(
+                '/out'
+            )
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+        self.assertFalse(path.exists('/out'))
+
+    @patch(
+        'scoring.Scoring._partition_file_name', return_value='manifest.tsv'
+    )
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_save_partitioned_manifest_file_name_fail(
+            self, mock_mismatches_to_df, mock_file_name
+    ):
+        # arrange
+        mock_mismatches_to_df.return_value = self.targeton_df
+        expected = 'Partitions map to the same file name'
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring('/ipcress.txt', 2, '/targetons.csv').save_partitioned(
+                '/out'
+            )
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+        self.assertFalse(path.exists('/out'))
+
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_save_partitioned_buckets_keep_pairs_together(
+            self, mock_mismatches_to_df
+    ):
+        # arrange
+        mock_mismatches_to_df.return_value = self.df
+
+        # act
+        Scoring('/ipcress.txt', 2).save_partitioned('/out', buckets=2)
+        manifest = pd.read_csv('/out/manifest.tsv', sep='\t')
+        pairs = [
+            pd.read_csv(f'/out/{file_name}', sep='\t')['Primer pair']
+            for file_name in manifest['File']
+        ]
+
+        # assert
+        self.assertEqual(manifest['Rows'].sum(), 9)
+        self.assertEqual(sum(len(set(p)) for p in pairs), 3)
+        for file_pairs in pairs:
+            self.assertTrue((file_pairs.value_counts() == 3).all())
+
+    @patch('scoring.Scoring.mismatches_to_df')
+    def test_save_partitioned_no_targeton_csv_fail(
+            self, mock_mismatches_to_df
+    ):
+        # arrange
+        mock_mismatches_to_df.return_value = self.df
+        expected = (
+            'Targeton csv or number of buckets required to partition output'
+        )
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring('/ipcress.txt', 2).save_partitioned('/out')
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_count_store_write_tsv_matches_scoring_output(self):
+        # arrange
+        scoring = Scoring('/ipcress.txt', 2, '/targetons.csv')
+        scoring.add_scores_to_df()
+        scoring.save_mismatches('/expected.tsv')
+        store = CountStore(':memory:', 2)
+        store.add_targetons('/targetons.csv')
+        store.add_ipcress('/ipcress.txt')
+
+        # act
+        store.write_tsv('/actual.tsv')
+
+        # assert
+        with open('/expected.tsv') as f:
+            expected = f.read()
+        with open('/actual.tsv') as f:
+            actual = f.read()
+        self.assertEqual(actual, expected)
+
+    def test_count_store_targeton_df_returns_one_targeton(self):
+        # arrange
+        scoring = Scoring('/ipcress.txt', 2, '/targetons.csv')
+        scoring.add_scores_to_df()
+        expected = scoring.mismatch_df.loc[['Targeton_1']]
+        store = CountStore(':memory:', 2)
+        store.add_targetons('/targetons.csv')
+        store.add_ipcress('/ipcress.txt')
+
+        # act
+        actual = store.targeton_df('Targeton_1')
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_count_store_appends_counts(self):
+        # arrange
+        file_contents = (
+            'ipcress: 13:filter(unmasked) BRCA1_exon1_1 '
+            '207 A 32315485 2 B 32315669 1 forward\n'
+        )
+        self.fs.create_file('/shard.txt', contents=file_contents)
+        store = CountStore(':memory:', 2)
+        store.add_ipcress('/ipcress.txt')
+        expected = ['BRCA1_exon1_1', 'A', 1, 0, 1, 0, 0]
+
+        # act
+        store.add_ipcress('/shard.txt')
+        actual = [row[:7] for row in store.rows() if row[:2] == [
+            'BRCA1_exon1_1', 'A'
+        ]][0]
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_count_store_same_shard_twice_fail(self):
+        # arrange
+        with open('/ipcress.txt') as f:
+            self.fs.create_file('/copy.txt', contents=f.read())
+        store = CountStore(':memory:', 2)
+        store.add_ipcress('/ipcress.txt')
+        expected_rows = list(store.rows())
+        expected = "ipcress file already added to count store: '/copy.txt'"
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            store.add_ipcress('/copy.txt')
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+        self.assertEqual(list(store.rows()), expected_rows)
+
+    def test_count_store_invalid_shard_rolled_back(self):
+        # arrange
+        self.fs.create_file('/invalid.txt', contents=(
+            'ipcress: 13:filter(unmasked) BRCA1_exon1_1 '
+            '207 A 32315485 0 B 32315669 0 forward\n'
+            'invalid'
+        ))
+        store = CountStore(':memory:', 2)
+        store.add_ipcress('/ipcress.txt')
+        expected = list(store.rows())
+
+        # act
+        with self.assertRaises(ScoringError):
+            store.add_ipcress('/invalid.txt')
+        actual = list(store.rows())
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_mismatches_to_df_selected_pairs_success(self):
+        # arrange
+        expected = self.df.loc[['BRCA1_exon1_1', 'SMARCA4_exon24_3']]
+
+        # act
+        actual = Scoring.mismatches_to_df(
+            '/ipcress.txt', 2,
+            pairs={b'BRCA1_exon1_1', b'SMARCA4_exon24_3'}
+        )
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_mismatches_to_df_skips_lines_of_other_pairs(self):
+        # arrange
+        file_contents = (
+            'ipcress: 1:filter(unmasked) SMARCA4_exon24_1 not parsed\n'
+            'ipcress: 13:filter(unmasked) BRCA1_exon1_1 '
+            '207 A 32315485 0 B 32315669 0 forward\n'
+        )
+        self.fs.create_file('/skipped.txt', contents=file_contents)
+        expected = self.df.loc[['BRCA1_exon1_1']]
+
+        # act
+        actual = Scoring.mismatches_to_df(
+            '/skipped.txt', 2, pairs={b'BRCA1_exon1_1'}
+        )
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_mismatches_to_df_no_selected_pair_data_fail(self):
+        # arrange
+        expected = (
+            "No data for selected primer pairs in "
+            "ipcress file: '/ipcress.txt'"
+        )
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring.mismatches_to_df('/ipcress.txt', 2, pairs={b'other'})
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_select_pairs_no_filter_returns_none(self):
+        # act
+        actual = Scoring.select_pairs(targeton_csv='/targetons.csv')
+
+        # assert
+        self.assertIsNone(actual)
+
+    def test_select_pairs_pairs_and_targetons_success(self):
+        # arrange
+        expected = {b'BRCA1_exon1_1', b'other'}
+
+        # act
+        actual = Scoring.select_pairs(
+            {'other'}, {'Targeton_2'}, '/targetons.csv'
+        )
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_select_pairs_csv_pairs_only_success(self):
+        # arrange
+        expected = {
+            b'SMARCA4_exon24_1', b'SMARCA4_exon24_3', b'BRCA1_exon1_1'
+        }
+
+        # act
+        actual = Scoring.select_pairs(
+            targeton_csv='/targetons.csv', csv_pairs_only=True
+        )
+
+        # assert
+        self.assertEqual(actual, expected)
+
+    def test_select_pairs_targetons_without_csv_fail(self):
+        # arrange
+        expected = 'Targeton csv required to select primer pairs by targeton'
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring.select_pairs(targetons={'Targeton_1'})
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
     @patch('scoring.Scoring.mismatches_to_df')
     def check_score_df(self, mock_mismatches_to_df, check_like):
         # arrange
@@ -430,3 +1101,133 @@ class TestScoring(TestCase):
 
         # assert
         self.assertEqual(actual, expected)
+
+    def test_score_async_returns_scored_mismatches(self):
+        # arrange
+        expected = [np.nan, np.nan, 0, np.nan, np.nan, 100000]
+
+        # act
+        scoring = asyncio.run(score_async('/ipcress.txt', 2))
+        actual = scoring.mismatch_df['Score'].tolist()[:6]
+
+        # assert
+        np.testing.assert_equal(actual, expected)
+
+    def test_score_async_saves_output_file(self):
+        # act
+        asyncio.run(score_async('/ipcress.txt', 2, output_file='/out.tsv'))
+
+        # assert
+        self.assertTrue(path.exists('/out.tsv'))
+
+    @patch('scoring.PROGRESS_LINES', 1)
+    def test_mismatches_to_df_cancelled_fail(self):
+        # arrange
+        cancel = threading.Event()
+        cancel.set()
+        expected = 'Scoring cancelled'
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring.mismatches_to_df('/ipcress.txt', 2, cancel=cancel)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_score_async_timeout_skips_output_file(self):
+        # arrange
+        release = threading.Event()
+        executor = ThreadPoolExecutor(1)
+
+        # act
+        # scoring blocks until after the timeout, wherever it has got to
+        with patch(
+                'scoring.Scoring.add_scores_to_df',
+                side_effect=lambda: release.wait()
+        ), self.assertRaises(asyncio.TimeoutError):
+            try:
+                asyncio.run(score_async(
+                    '/ipcress.txt', 2, output_file='/out.tsv',
+                    executor=executor, timeout=0.01
+                ))
+            finally:
+                release.set()
+                executor.shutdown(wait=True)
+
+        # assert
+        self.assertFalse(path.exists('/out.tsv'))
+
+    @patch('scoring._score')
+    def test_score_async_uses_manager_cancel_event(self, mock_score):
+        # arrange
+        manager = Mock()
+
+        # act
+        asyncio.run(score_async('/ipcress.txt', 2, manager=manager))
+
+        # assert
+        manager.Event.assert_called_once_with()
+        self.assertIs(mock_score.call_args[0][-1], manager.Event.return_value)
+
+    # the job runs until the timeout sets its cancel event
+    @patch('scoring._score', side_effect=lambda *args: args[-1].wait())
+    def test_score_async_timeout_fail(self, mock_score):
+        # act
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(score_async('/ipcress.txt', 2, timeout=0.01))
+
+
+class TestScoringMappedFile(RealFileTestCase):
+    # pyfakefs files cannot be memory-mapped, so these use real files
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.ipcress_file = path.join(self.tmp_dir.name, 'ipcress.txt')
+        self.lines = (
+            'ipcress: 10:filter(unmasked) SMARCA4_exon24_1 '
+            '300 A 48790792 1 A 48791074 2 single_A\n'
+            'ipcress: 19:filter(unmasked) SMARCA4_exon24_1 '
+            '252 A 11027747 0 B 11027978 0 forward\n'
+            'ipcress: 13:filter(unmasked) BRCA1_exon1_1 '
+            '207 A 32315485 0 B 32315669 0 forward\n'
+        )
+
+    def write_ipcress_file(self, file_contents):
+        with open(self.ipcress_file, 'w') as f:
+            f.write(file_contents)
+
+    def test_mismatches_to_df_maps_file(self):
+        # arrange
+        self.write_ipcress_file(
+            self.lines + '-- completed ipcress analysis\n'
+        )
+        map_file = scoring._map_file
+        buffers = []
+
+        def record_buffer(fh):
+            buffers.append(map_file(fh))
+            return buffers[-1]
+
+        with patch('scoring._map_file', lambda fh: fh.read()):
+            expected = Scoring.mismatches_to_df(self.ipcress_file, 2)
+
+        # act
+        with patch('scoring._map_file', record_buffer):
+            actual = Scoring.mismatches_to_df(self.ipcress_file, 2)
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+        self.assertIsInstance(buffers[0], mmap.mmap)
+        self.assertTrue(buffers[0].closed)
+
+    def test_mismatches_to_df_mapped_file_invalid_line_fail(self):
+        # arrange
+        self.write_ipcress_file(self.lines + 'invalid\n' + self.lines)
+        expected = f"Invalid ipcress file: '{self.ipcress_file}'"
+
+        # act
+        with self.assertRaises(ScoringError) as cm:
+            Scoring.mismatches_to_df(self.ipcress_file, 2)
+
+        # assert
+        self.assertEqual(str(cm.exception), expected)